@@ -1,12 +1,67 @@
 import adsk.core
 import adsk.fusion
-import adsk.cam
-import traceback
 
+import itertools
 import math
 
 
+# slots = [(value, bit_length),]
+def get_slots(pattern_string):
+    bits_count = len(pattern_string)
+    pattern = int(pattern_string, 2)
+    # first string character is the most significant bit, so bit j is character bits_count - 1 - j;
+    # rotating right by one and xor-ing marks every bit which differs from the previous character
+    rotated = (pattern >> 1) | ((pattern & 1) << (bits_count - 1))
+    transitions = pattern ^ rotated
+    if not transitions:
+        return [(pattern & 1, bits_count)]
+
+    # slot start bit indexes, collected lowest first and reversed into string order
+    starts = []
+    while transitions:
+        lowest = transitions & -transitions
+        starts.append(lowest.bit_length() - 1)
+        transitions ^= lowest
+    starts.reverse()
+    # a slot wrapping over the pattern end goes first, like edge slots merged together
+    if starts[0] != bits_count - 1:
+        starts.insert(0, starts.pop())
+
+    slots = []
+    for i, start in enumerate(starts):
+        end = starts[(i + 1) % len(starts)]
+        slots.append(((pattern >> start) & 1, (start - end) % bits_count))
+    return slots
+
+
+# TODO these variables are not in Fusion document for now
+BITS_PATTERN_STRING = '000000000000111000000110000001111111111111000111111001111110'
+HEADS_DISTANCE_BITS = 5
+HEADS_COUNT = 6
+
+# everything below depends on the constants above only, so it is computed once at import
+BITS_PATTERN = bytes(map(int, BITS_PATTERN_STRING))
+assert sorted(set(BITS_PATTERN)) == [0, 1], 'Pattern contains wrong characters'
+BIT_LENGTH_ANGLE = (2 * math.pi) / len(BITS_PATTERN)
+SLOTS = tuple(get_slots(BITS_PATTERN_STRING))
+# slot boundaries: slot i spans SLOT_ANGLES[i]..SLOT_ANGLES[i + 1]
+SLOT_ANGLES = (0,) + tuple(itertools.accumulate(slot[1] * BIT_LENGTH_ANGLE for slot in SLOTS))
+SLOT_DIRECTIONS = tuple((math.cos(angle), math.sin(angle)) for angle in SLOT_ANGLES)
+HEADS_DISTANCE_ANGLE = (HEADS_DISTANCE_BITS * 2 * math.pi) / len(BITS_PATTERN)
+HEADS_ANGLES = tuple(HEADS_DISTANCE_ANGLE * i for i in range(HEADS_COUNT))
+
+
 class UserParameters:
+    __slots__ = (
+        "design", "defaults",
+        "sensor_outer_diameter", "slots_disk_thickness", "ports_disk_thickness", "head_disk_thickness",
+        "center_axis_diameter", "head_diameter", "head_to_disk_gap", "ports_disk_to_slots_gap",
+        "bits_pattern_string", "heads_distance_bits", "heads_count",
+        "bits_pattern", "bit_length_angle", "slots", "slot_angles", "slot_directions",
+        "sensor_outer_radius", "head_radius", "slots_disk_outer_radius", "slots_disk_inner_radius",
+        "heads_distance_angle", "heads_angles", "head_center_distance",
+    )
+
     def _get_value_from_design(self, name):
         try:
             return self.design.userParameters.itemByName(name).value
@@ -44,59 +99,59 @@ class UserParameters:
         self.head_to_disk_gap = self._get_value_from_design("head_to_disk_gap")
         self.ports_disk_to_slots_gap = self._get_value_from_design("ports_disk_to_slots_gap")
 
-        # TODO these variables are not in Fusion document for now
-        self.bits_pattern_string = '000000000000111000000110000001111111111111000111111001111110'
-        self.heads_distance_bits = 5
-        self.heads_count = 6
+        self.bits_pattern_string = BITS_PATTERN_STRING
+        self.heads_distance_bits = HEADS_DISTANCE_BITS
+        self.heads_count = HEADS_COUNT
 
-        self.bits_pattern = list(map(int, self.bits_pattern_string))
-
-        self.bit_length_angle = (2 * math.pi) / len(self.bits_pattern)
-        assert sorted(set(self.bits_pattern)) == [0, 1], 'Pattern contains wrong characters'
+        self.bits_pattern = BITS_PATTERN
+        self.bit_length_angle = BIT_LENGTH_ANGLE
+        self.slots = SLOTS
+        self.slot_angles = SLOT_ANGLES
+        self.slot_directions = SLOT_DIRECTIONS
 
         self.sensor_outer_radius = self.sensor_outer_diameter / 2
         self.head_radius = self.head_diameter / 2
         self.slots_disk_outer_radius = self.sensor_outer_radius - self.ports_disk_to_slots_gap
         self.slots_disk_inner_radius = self.slots_disk_outer_radius - self.head_diameter - self.head_to_disk_gap * 2
-        self.heads_distance_angle = (self.heads_distance_bits * 2 * math.pi) / len(self.bits_pattern)
+        self.heads_distance_angle = HEADS_DISTANCE_ANGLE
+        self.heads_angles = HEADS_ANGLES
         self.head_center_distance = self.slots_disk_inner_radius + self.head_to_disk_gap + self.head_diameter / 2
 
 
 
-def ra2xy(center, radius, angle):
+def rd2xy(center, radius, direction):
+    # direction = (cos(angle), sin(angle)), to share trigonometry between radii
     return adsk.core.Point3D.create(
-                    center.x + radius * math.cos(angle),
-                    center.y + radius * math.sin(angle),
+                    center.x + radius * direction[0],
+                    center.y + radius * direction[1],
                     0
                 )
 
 
-def produce_slots(root, plane, user_params: UserParameters):
-    # slots = [(value, bit_length),]
-    def get_slots(pattern):
-        bits_count = len(pattern)
-        slots = []
-
-        current_length = 1
-        for bit_pos in range(bits_count):
-            current_bit = pattern[bit_pos]
-            if bit_pos < bits_count - 1:
-                next_bit = pattern[bit_pos + 1]
-            else:
-                next_bit = pattern[0]
-
-            if current_bit != next_bit or bit_pos == bits_count - 1:
-                slots.append((current_bit, current_length))
-                current_length = 1
-            else:
-                current_length += 1
-        # merge edge slots if are the same
-        if slots[0][0] == slots[-1][0]:
-            extra_length = slots[-1][1]
-            del slots[-1]
-            slots[0] = (slots[0][0], slots[0][1] + extra_length)
-        return slots
+def ra2xy(center, radius, angle):
+    return rd2xy(center, radius, (math.cos(angle), math.sin(angle)))
+
+
+def to_object_collection(items):
+    # createWithArray fills the collection in one call, older Fusion versions lack it
+    if hasattr(adsk.core.ObjectCollection, "createWithArray"):
+        return adsk.core.ObjectCollection.createWithArray(items)
+    collection = adsk.core.ObjectCollection.create()
+    for item in items:
+        collection.add(item)
+    return collection
+
+
+def is_bounded_by(profile, curve):
+    # True for a profile which is just the inside of a closed curve, e.g. a hole
+    loops = profile.profileLoops
+    if loops.count != 1:
+        return False
+    profile_curves = loops.item(0).profileCurves
+    return profile_curves.count == 1 and profile_curves.item(0).sketchEntity == curve
 
+
+def produce_slots(root, plane, user_params: UserParameters):
     sketches = root.sketches
     extrudes = root.features.extrudeFeatures
 
@@ -104,33 +159,45 @@ def produce_slots(root, plane, user_params: UserParameters):
     sketch.name = "slots"
     sketch_center_point = sketch.modelToSketchSpace(plane.geometry.origin)
 
-    # axis hole
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
-
-    # solid center
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.slots_disk_inner_radius)
+    sketch_circles = sketch.sketchCurves.sketchCircles
+    sketch_arcs = sketch.sketchCurves.sketchArcs
+    sketch_lines = sketch.sketchCurves.sketchLines
 
-    # slots
-    slots = get_slots(user_params.bits_pattern)
-    start_angle = 0
-    for slot in slots:
-        arc_length = slot[1] * user_params.bit_length_angle
-        if slot[0] == 1:
-            ark_start_point = ra2xy(sketch_center_point, user_params.slots_disk_outer_radius, start_angle)
-            ark_end_point = ra2xy(sketch_center_point, user_params.slots_disk_outer_radius, start_angle + arc_length)
+    # defer profile recomputation until all curves are in place
+    sketch.isComputeDeferred = True
+    try:
+        # axis hole
+        axis_hole_circle = sketch_circles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
+
+        # solid center
+        sketch_circles.addByCenterRadius(sketch_center_point, user_params.slots_disk_inner_radius)
+
+        # slots
+        slots = user_params.slots
+        # slot boundaries: slot i spans angles[i]..angles[i + 1]
+        angles = user_params.slot_angles
+        directions = user_params.slot_directions
+        outer_radius = user_params.slots_disk_outer_radius
+        inner_radius = user_params.slots_disk_inner_radius
+        # slot values alternate, so only every other slot is an opening
+        # and every boundary point belongs to exactly one opening
+        first_slot = 0 if slots[0][0] == 1 else 1
+        for i in range(first_slot, len(slots), 2):
+            arc_length = angles[i + 1] - angles[i]
             # slot ark
-            sketch.sketchCurves.sketchArcs.addByCenterStartSweep(sketch_center_point, ark_start_point, arc_length)
-            # slot sides
-            side_cw_start_point = ra2xy(sketch_center_point, user_params.slots_disk_inner_radius, start_angle)
-            side_ccw_start_point = ra2xy(sketch_center_point, user_params.slots_disk_inner_radius, start_angle + arc_length)
-            sketch.sketchCurves.sketchLines.addByTwoPoints(side_cw_start_point, ark_start_point)
-            sketch.sketchCurves.sketchLines.addByTwoPoints(side_ccw_start_point, ark_end_point)
-        start_angle += arc_length
-
-    sketch_profiles = adsk.core.ObjectCollection.create()
-    for profile in sketch.profiles:
-        sketch_profiles.add(profile)
-    sketch_profiles.removeByIndex(0)  # remove axis hole (the ugly way)
+            ark_start_point = rd2xy(sketch_center_point, outer_radius, directions[i])
+            ark = sketch_arcs.addByCenterStartSweep(sketch_center_point, ark_start_point, arc_length)
+            # slot sides, attached to the ark ends
+            side_cw_start_point = rd2xy(sketch_center_point, inner_radius, directions[i])
+            side_ccw_start_point = rd2xy(sketch_center_point, inner_radius, directions[i + 1])
+            sketch_lines.addByTwoPoints(side_cw_start_point, ark.startSketchPoint)
+            sketch_lines.addByTwoPoints(side_ccw_start_point, ark.endSketchPoint)
+    finally:
+        sketch.isComputeDeferred = False
+
+    sketch_profiles = to_object_collection(
+        [profile for profile in sketch.profiles if not is_bounded_by(profile, axis_hole_circle)]
+    )
     distance = adsk.core.ValueInput.createByReal(user_params.slots_disk_thickness)
     extrude1 = extrudes.addSimple(sketch_profiles, distance, adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
     body = extrude1.bodies.item(0)
@@ -158,25 +225,36 @@ def produce_ports(root, plane, user_params: UserParameters):
     sketch.name = "ports"
     sketch_center_point = sketch.modelToSketchSpace(plane.geometry.origin)
 
-    # main solid
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.sensor_outer_radius)
-
-    # axis hole
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
-
-    # ports
-    for i in range(user_params.heads_count):
-        start_angle = user_params.heads_distance_angle * i
-        point_cw_far = ra2xy(sketch_center_point, user_params.slots_disk_outer_radius - user_params.head_to_disk_gap, start_angle)
-        point_cw_near = ra2xy(sketch_center_point, user_params.slots_disk_inner_radius + user_params.head_to_disk_gap, start_angle)
-        point_ccw_far = ra2xy(sketch_center_point, user_params.slots_disk_outer_radius - user_params.head_to_disk_gap,
-                              start_angle + user_params.bit_length_angle)
-        point_ccw_near = ra2xy(sketch_center_point, user_params.slots_disk_inner_radius + user_params.head_to_disk_gap,
-                               start_angle + user_params.bit_length_angle)
-        sketch.sketchCurves.sketchLines.addByTwoPoints(point_cw_near, point_cw_far)
-        sketch.sketchCurves.sketchLines.addByTwoPoints(point_cw_far, point_ccw_far)
-        sketch.sketchCurves.sketchLines.addByTwoPoints(point_ccw_far, point_ccw_near)
-        sketch.sketchCurves.sketchLines.addByTwoPoints(point_ccw_near, point_cw_near)
+    sketch_circles = sketch.sketchCurves.sketchCircles
+    sketch_lines = sketch.sketchCurves.sketchLines
+
+    # defer profile recomputation until all curves are in place
+    sketch.isComputeDeferred = True
+    try:
+        # main solid
+        sketch_circles.addByCenterRadius(sketch_center_point, user_params.sensor_outer_radius)
+
+        # axis hole
+        sketch_circles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
+
+        # ports
+        far_radius = user_params.slots_disk_outer_radius - user_params.head_to_disk_gap
+        near_radius = user_params.slots_disk_inner_radius + user_params.head_to_disk_gap
+        bit_length_angle = user_params.bit_length_angle
+        for start_angle in user_params.heads_angles:
+            cw_direction = (math.cos(start_angle), math.sin(start_angle))
+            ccw_direction = (math.cos(start_angle + bit_length_angle), math.sin(start_angle + bit_length_angle))
+            point_cw_far = rd2xy(sketch_center_point, far_radius, cw_direction)
+            point_cw_near = rd2xy(sketch_center_point, near_radius, cw_direction)
+            point_ccw_far = rd2xy(sketch_center_point, far_radius, ccw_direction)
+            point_ccw_near = rd2xy(sketch_center_point, near_radius, ccw_direction)
+            # chain the sides through the sketch points already created
+            side_cw = sketch_lines.addByTwoPoints(point_cw_near, point_cw_far)
+            side_far = sketch_lines.addByTwoPoints(side_cw.endSketchPoint, point_ccw_far)
+            side_ccw = sketch_lines.addByTwoPoints(side_far.endSketchPoint, point_ccw_near)
+            sketch_lines.addByTwoPoints(side_ccw.endSketchPoint, side_cw.startSketchPoint)
+    finally:
+        sketch.isComputeDeferred = False
 
     profile = sketch.profiles[0]
     distance = adsk.core.ValueInput.createByReal(-user_params.ports_disk_thickness)
@@ -186,30 +264,42 @@ def produce_ports(root, plane, user_params: UserParameters):
     return body
 
 
-def produce_heads(root, plane, user_params: UserParameters):
+def produce_heads(root, plane, user_params: UserParameters, target_body):
     sketches = root.sketches
     extrudes = root.features.extrudeFeatures
     sketch = sketches.add(plane)
     sketch.name = "heads"
     sketch_center_point = sketch.modelToSketchSpace(plane.geometry.origin)
 
-    # main solid
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.sensor_outer_radius)
-
-    # axis hole
-    sketch.sketchCurves.sketchCircles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
-
-    # heads
-    for i in range(user_params.heads_count):
-        start_angle = user_params.heads_distance_angle * i
-        point_head_center = ra2xy(sketch_center_point, user_params.head_center_distance, start_angle + user_params.bit_length_angle / 2)
-        sketch.sketchCurves.sketchCircles.addByCenterRadius(point_head_center, user_params.head_radius)
+    sketch_circles = sketch.sketchCurves.sketchCircles
 
+    # defer profile recomputation until all curves are in place
+    sketch.isComputeDeferred = True
+    try:
+        # main solid
+        sketch_circles.addByCenterRadius(sketch_center_point, user_params.sensor_outer_radius)
+
+        # axis hole
+        sketch_circles.addByCenterRadius(sketch_center_point, user_params.center_axis_diameter / 2)
+
+        # heads
+        head_center_distance = user_params.head_center_distance
+        head_radius = user_params.head_radius
+        half_bit_angle = user_params.bit_length_angle / 2
+        for start_angle in user_params.heads_angles:
+            point_head_center = ra2xy(sketch_center_point, head_center_distance, start_angle + half_bit_angle)
+            sketch_circles.addByCenterRadius(point_head_center, head_radius)
+    finally:
+        sketch.isComputeDeferred = False
+
+    # join straight into the target body instead of combining a separate body afterwards
     profile = sketch.profiles[0]
     distance = adsk.core.ValueInput.createByReal(-user_params.head_disk_thickness)
-    extrude1 = extrudes.addSimple(profile, distance, adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
+    extrude_input = extrudes.createInput(profile, adsk.fusion.FeatureOperations.JoinFeatureOperation)
+    extrude_input.setDistanceExtent(False, distance)
+    extrude_input.participantBodies = [target_body]
+    extrude1 = extrudes.add(extrude_input)
     body = extrude1.bodies.item(0)
-    body.name = "heads"
     return body
 
 
@@ -226,11 +316,14 @@ def run(context):
             return
 
         user_params = UserParameters(design)
+        is_parametric = design.designType == adsk.fusion.DesignTypes.ParametricDesignType
+        if is_parametric:
+            timeline_start = design.timeline.markerPosition
+
         # create new component from root
         sensor_component = design.rootComponent.occurrences.addNewComponent(adsk.core.Matrix3D.create()).component
         sensor_component.name = "STGC Sensor RUN"
         planes = sensor_component.constructionPlanes
-        features = sensor_component.features
 
         # TODO plane is need to be selectable by user
         # sel = ui.selectEntity('Select a path to create a pipe', 'Edges,SketchCurves')
@@ -246,15 +339,13 @@ def run(context):
         plane_for_heads_input = planes.createInput()
         plane_for_heads_input.setByOffset(plane_xy, plane_for_heads_offset)
         plane_for_heads = planes.add(plane_for_heads_input)
-        heads_body = produce_heads(sensor_component, plane_for_heads, user_params)
+        produce_heads(sensor_component, plane_for_heads, user_params, ports_body)
 
-        # merge bodies
-        tool_bodies_collection = adsk.core.ObjectCollection.create()
-        tool_bodies_collection.add(heads_body)
-        combine_feature_input = features.combineFeatures.createInput(ports_body, tool_bodies_collection)
-        combine_feature_input.operation = adsk.fusion.FeatureOperations.JoinFeatureOperation
-        features.combineFeatures.add(combine_feature_input)
+        # collapse everything created above into a single timeline node
+        if is_parametric:
+            design.timeline.timelineGroups.add(timeline_start, design.timeline.markerPosition - 1).name = "STGC Sensor"
 
     except:
         if ui:
+            import traceback
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))